@@ -1,22 +1,53 @@
-import json
+import asyncio
+import hashlib
 import random
-from typing import Any
-from openai import OpenAI
-import os
-from instructor.batch import BatchJob
-from instructor import from_openai
+import re
+from pathlib import Path
+from openai import AsyncOpenAI
+import diskcache
+import orjson
+import tiktoken
+from pydantic import ValidationError
+from tqdm.auto import tqdm
 
 from pydantic_models.article_corpus_model import ArticleCorpus
+from rate_limiter import RateLimiter
+
+# The system prompt is the same for every request and comes first, so OpenAI's prompt caching can reuse it.
+# Everything that does not change between requests belongs here and not in the user prompt.
+SYSTEM_PROMPT = (
+    """
+    You are a journalist for a reputable local news organization covering international conflicts. 
+    You are given old articles from yourself and based on these articles are to write new articles on different events that could happen in the same conflict in the same style. 
+    Do not rewrite the old articles, but use them as inspiration for new articles.
+    Each old article is given with its headline, its subheadline and its paragraphs, separated by a line starting with "Headline:", "Subheadline:" and "Paragraphs:".
+    Every new article needs a headline, a subheadline and paragraphs as well.
+    The headline is a single short sentence, the subheadline summarizes the event in one or two sentences and the paragraphs report the event in detail.
+    Keep the tone, the length and the level of detail of the old articles, and mention places, dates and sources the way the old articles do."""
+)
+
+# Boilerplate text left in the paragraphs of some scraped articles, removed once when loading the articles
+BOILERPLATE_TEXTS = ("\nLorem ipsum dolor sit amet, consectetur.",)
+BOILERPLATE_RE = re.compile("|".join(map(re.escape, BOILERPLATE_TEXTS)))
+
+# Number of draws after which a combination of articles that was already used is accepted
+MAX_SAMPLE_ATTEMPTS = 10
 
 
 class ArticleGenerator:
     def __init__(
         self,
-        article_json_path: str = "found_articles.json",
-        article_output_path: str = "generated_articles.json",
+        article_json_path: str = "found_articles.jsonl",
+        article_output_path: str = "generated_articles.jsonl",
+        batch_jsonl_path: str = "batch_file.jsonl",
+        batch_response_path: str = "batch_response.jsonl",
         num_articles_to_choose: int = 3,
         model_name: str = "gpt-4o-mini",
         temperature: float = 0,
+        requests_per_minute: int = 500,
+        tokens_per_minute: int = 200_000,
+        batch_threshold: int = 100,
+        response_cache_path: str | None = ".llm_cache",
     ):
         """
         Uses a GPT model to generate more articles based on the articles given in the JSON file under the path article_json_path.
@@ -24,11 +55,13 @@ class ArticleGenerator:
 
         Args:
         article_json_path: str
-            Path to the JSON file containing the articles
+            Path to the JSON line file containing the articles
         article_output_path: str
-            Path to the JSON file where the generated articles should be saved
-        batch_file_path: str
+            Path to the JSON line file where the generated articles should be saved
+        batch_jsonl_path: str
             Path to the JSON line file of the prompts to be used with OpenAI's batch API
+        batch_response_path: str
+            Path to the JSON line file where the response of OpenAI's batch API is downloaded to
         num_articles_to_choose: int
             Number of articles to choose from the JSON file (amount used for few shot prompting)
         times_to_generate: int
@@ -37,44 +70,107 @@ class ArticleGenerator:
             Name of the GPT model to use
         temperature: float
             Temperature parameter for the GPT model
+        requests_per_minute: int
+            Request limit per minute of the OpenAI account, used to cap the number of concurrent requests
+        tokens_per_minute: int
+            Token limit per minute of the OpenAI account
+        batch_threshold: int
+            Number of times to generate from which on OpenAI's batch API is used instead of single requests
+        response_cache_path: str | None
+            Path to the directory caching the responses of the OpenAI API for identical prompts, None disables the cache
 
         """
 
         self.article_output_path: str = article_output_path
+        self.batch_jsonl_path: str = batch_jsonl_path
+        self.batch_response_path: str = batch_response_path
+        self.batch_threshold: int = batch_threshold
         self.num_articles_to_choose: int = num_articles_to_choose
         self.model_name: str = model_name
         self.temperature: float = temperature
 
-        with open(article_json_path, "r") as f:
-            self.articles: dict = json.load(f)
+        # The articles are saved one per line, a later line of the same URL replaces an earlier one
+        self.articles: dict = {}
+        for line in Path(article_json_path).read_bytes().splitlines():
+            if line:
+                article = orjson.loads(line)
+                self.articles[article["url"]] = article
+
+        # Keep the articles in a list so that sampling does not need to copy the keys every time
+        self.article_list: list[dict] = list(self.articles.values())
+
+        # Combinations of articles already used for a prompt, as the same prompt would generate the same articles again
+        self.seen_samples: set[tuple[int, ...]] = set()
+
+        # Remove boilerplate like lorem ipsum from paragraphs once instead of every time an article is chosen
+        for article in self.article_list:
+            article["paragraphs"] = BOILERPLATE_RE.sub("", article["paragraphs"])
 
         # Reads the API key from the environment variable
         # export OPENAI_API_KEY="your_api_key_here"
-        self.client = from_openai(OpenAI())
-
-        self.system_prompt: str = (
-            """
-            You are a journalist for a reputable local news organization covering international conflicts. 
-            You are given old articles from yourself and based on these articles are to write new articles on different events that could happen in the same conflict in the same style. 
-            Do not rewrite the old articles, but use them as inspiration for new articles."""
+        self.client = AsyncOpenAI()
+
+        # Derive the structured output format from the pydantic model once instead of for every request
+        response_schema = ArticleCorpus.model_json_schema()
+
+        # OpenAI's strict structured outputs require every object to forbid additional properties,
+        # this is only set in the schema so that reading saved articles with further keys still works
+        for object_schema in [response_schema, *response_schema["$defs"].values()]:
+            object_schema["additionalProperties"] = False
+
+        self.response_format: dict = {
+            "type": "json_schema",
+            "json_schema": {
+                "name": "ArticleCorpus",
+                "schema": response_schema,
+                "strict": True,
+            },
+        }
+
+        # Caps the number of requests in flight when generating concurrently
+        self.max_concurrent_requests: int = max(1, requests_per_minute // 60)
+
+        # Throttles the requests before they are sent instead of running into the rate limits of the API
+        self.rate_limiter = RateLimiter(
+            max_requests_per_minute=requests_per_minute,
+            max_tokens_per_minute=tokens_per_minute,
         )
+        try:
+            self.encoding = tiktoken.encoding_for_model(model_name)
+        except KeyError:
+            self.encoding = tiktoken.get_encoding("o200k_base")
+
+        self.system_prompt: str = SYSTEM_PROMPT
+
+        # The system prompt is the same for every request, so its tokens are only counted once
+        self.system_prompt_tokens: int = len(self.encoding.encode(self.system_prompt))
+
+        # Only with temperature 0 the same prompt is expected to give the same response, so only then it is cached
+        self.response_cache = None
+        if response_cache_path is not None and temperature == 0:
+            self.response_cache = diskcache.Cache(response_cache_path)
 
     def choose_random_articles(self) -> list[dict]:
         """
         Chooses random articles from the JSON file according to the num_articles_to_choose parameter.
+        Combinations of articles that were already chosen are drawn again, up to MAX_SAMPLE_ATTEMPTS times.
 
         Returns:
         list[dict]
             List of randomly chosen articles from the JSON file
         """
 
-        random_articles: list = random.sample(
-            list(self.articles.keys()), self.num_articles_to_choose
-        )
+        for _ in range(MAX_SAMPLE_ATTEMPTS):
+            indices = random.sample(
+                range(len(self.article_list)), self.num_articles_to_choose
+            )
+            sample = tuple(sorted(indices))
+            if sample not in self.seen_samples:
+                break
 
-        random_articles = [self.articles[article] for article in random_articles]
+        self.seen_samples.add(sample)
 
-        return random_articles
+        return [self.article_list[i] for i in indices]
 
     def create_openai_prompt(self, random_articles: list[dict]) -> str:
         """
@@ -88,97 +184,112 @@ class ArticleGenerator:
         str
             Few shot prompt for the GPT model
         """
-        prompt = ""
+        # The prompt starts with the same header for every request to extend the prefix shared with other requests
+        prompt_parts = ["Here are example articles to inspire you:\n"]
 
         # Only add the headline, subheadline and paragraphs to the prompt as the rest is extracted from the web page when analyzing unseen articles
-        for article in random_articles:
-            prompt += f"Headline: {article['headline']}\n"
-            prompt += f"Subheadline: {article['subheadline']}\n"
+        prompt_parts += [
+            f"Headline: {article['headline']}\n"
+            f"Subheadline: {article['subheadline']}\n"
+            f"Paragraphs: {article['paragraphs']}\n"
+            for article in random_articles
+        ]
 
-            # Remove lorem ipsum from paragraphs
-            article["paragraphs"] = article["paragraphs"].replace(
-                "\nLorem ipsum dolor sit amet, consectetur.", ""
-            )
-            prompt += f"Paragraphs: {article['paragraphs']}\n"
-
-        return prompt
+        return "".join(prompt_parts)
 
-    def send_openai_request(self, prompt: str):
+    async def send_openai_request(self, prompt: str):
         """
         Send a request to the OpenAI API with the few shot prompting, and return the generated article.
         Uses the API key, model name and temperature parameters provided in the constructor.
         Further uses the pydantic model ArticleGenerationPrompt to validate the response.
+        Responses to prompts that were already sent are read from the response cache instead.
         """
 
-        articles = self.client.chat.completions.create(
+        cache_key = hashlib.sha256(
+            f"{self.model_name}|{self.system_prompt}|{prompt}".encode()
+        ).hexdigest()
+        if self.response_cache is not None:
+            # The cache is stored on disk, so it is read outside of the event loop
+            content = await asyncio.to_thread(self.response_cache.get, cache_key)
+            if content is not None:
+                return ArticleCorpus.model_validate_json(content)
+
+        # Estimate the prompt tokens counted against the rate limit
+        n_tokens = self.system_prompt_tokens + len(self.encoding.encode(prompt))
+        await self.rate_limiter.acquire(n_tokens)
+
+        response = await self.client.chat.completions.create(
             model=self.model_name,
             messages=[
                 {"role": "system", "content": self.system_prompt},
                 {"role": "user", "content": prompt},
             ],
             temperature=self.temperature,
-            response_model=ArticleCorpus,
-            # tools=[openai.pydantic_function_tool(ArticleGenerationPrompt)],
+            response_format=self.response_format,
         )
 
+        content = response.choices[0].message.content
+        articles = ArticleCorpus.model_validate_json(content)
+
+        if self.response_cache is not None:
+            await asyncio.to_thread(self.response_cache.set, cache_key, content)
+
         return articles
 
     def save_generated_articles(self, articles: ArticleCorpus):
         """
-        Save the generated articles to the JSON file under the path article_output_path.
-        If the file does not exist, it should be created.
+        Append the generated articles to the JSON line file under the path article_output_path, one article per line.
+        If the file does not exist, it is created.
 
         Args:
         articles: ArticleGenerationPrompt
             The generated articles to save in the pydanctic model format
         """
-        # Bring the articles into a dictionary format
-
-        article_list = []
-        for article in articles.articles:
-            headline = article.Headline
-            subheadline = article.Subheadline
-            paragraphs = article.Paragraphs
-            article_list.append(
-                {
-                    "headline": headline,
-                    "subheadline": subheadline,
-                    "paragraphs": paragraphs,
-                }
-            )
+        # Only append the new articles instead of rewriting the whole file
+        with open(self.article_output_path, "ab") as f:
+            self.write_generated_articles(articles, f)
 
-        # Check if the file exists and create it if it does not
-        if not os.path.exists(self.article_output_path):
-            with open(self.article_output_path, "w") as f:
-                json.dump([], f)  # Create an empty JSON file
+    def write_generated_articles(self, articles: ArticleCorpus, f):
+        """
+        Write the generated articles to an already opened JSON line file, one article per line.
 
-        # Append the generated articles to the JSON file
-        with open(self.article_output_path, "r") as f:
-            data = json.load(f)
-        with open(self.article_output_path, "w") as f:
-            data += article_list
-            json.dump(data, f)
+        Args:
+        articles: ArticleGenerationPrompt
+            The generated articles to save in the pydanctic model format
+        f: BinaryIO
+            JSON line file opened in binary append mode
+        """
+        # Serialize straight from the pydantic model, the aliases give the lower case keys of the article files.
+        # The lines are written at once so that saves running in parallel threads do not interleave.
+        f.write(
+            b"".join(
+                article.model_dump_json(by_alias=True).encode() + b"\n"
+                for article in articles.articles
+            )
+        )
 
-    def generate_once(self):
+    async def generate_once(self):
         # Sample random articles
         random_articles: list[dict] = self.choose_random_articles()
 
         # Connect to OpenAI API and generate articles
         prompt = self.create_openai_prompt(random_articles)
-        response = self.send_openai_request(prompt)
+        response = await self.send_openai_request(prompt)
 
-        # Save generated articles to JSON file
-        self.save_generated_articles(response)
+        # Save generated articles to JSON line file without blocking the requests running in the meantime
+        await asyncio.to_thread(self.save_generated_articles, response)
 
-    def generate(self, n: int):
+    async def generate(self, n: int):
         """
         Randomly samples articles from the JSON file and uses them for few shot prompting with the GPT model.
-        This is repeated times_to_generate times.
+        This is repeated times_to_generate times, with the requests to the OpenAI API being sent concurrently.
+        From batch_threshold times on, all prompts are sent at once with OpenAI's batch API instead, which is cheaper
+        and has separate rate limits.
 
-        The input news articles are in a JSON file with the following structure:
-            "$URL": {
+        The input news articles are in a JSON line file with one article per line in the following structure:
+            {
             "url": "$URL",
-            "accessing-date": "$UTC_DATETIME_ACCESS",  # like "2024-08-25 12:34:14.660861+00:00"
+            "accessing-date": "$UTC_DATETIME_ACCESS",  # like "2024-08-25T12:34:14.660861+00:00"
             "last-modification": "$UTC_DATETIME_MODIFICATION",  # like "2024-08-23T15:42:14+00:00"
             "headline": "$HEADLINE",
             "subheadline": "$SUBHEADLINE",
@@ -196,75 +307,177 @@ class ArticleGenerator:
                     Paragraphs: str = Field(description="Paragraphs of the article")
                 articles: list[Article]
 
-        The generated articles are appended to a JSON file with the same structure, if it does not exist it should be created.
+        The generated articles are appended to a JSON line file with one article per line, if it does not exist it is created.
 
         Args:
         n: int
             Number of times to generate using the GPT model
         """
-        for i in range(0, n):
-            self.generate_once()
-            print(
-                f"Generated articles: {i+1} out of {n} with {self.num_articles_to_choose} chosen each. Sum of articles generated: {self.num_articles_to_choose*(i+1)}"
+        if n >= self.batch_threshold:
+            await self.generate_batch(n)
+            return
+
+        # Start a new request whenever one finishes instead of creating all n tasks upfront,
+        # so that only max_concurrent_requests prompts and responses are held at the same time
+        progress_bar = tqdm(total=n, desc="Generated responses")
+        pending_tasks: set[asyncio.Task] = set()
+        for _ in range(n):
+            if len(pending_tasks) >= self.max_concurrent_requests:
+                done_tasks, pending_tasks = await asyncio.wait(
+                    pending_tasks, return_when=asyncio.FIRST_COMPLETED
+                )
+                # Raise errors of the finished requests right away
+                for task in done_tasks:
+                    task.result()
+
+            task = asyncio.create_task(self.generate_once())
+            task.add_done_callback(lambda _: progress_bar.update())
+            pending_tasks.add(task)
+
+        await asyncio.gather(*pending_tasks)
+        progress_bar.close()
+
+        print(
+            f"{n} times generated with {self.num_articles_to_choose} chosen each and saved successfully under {self.article_output_path}."
+        )
+
+    async def generate_batch(self, n: int):
+        """
+        Creates the batch file with n prompts, sends it to OpenAI's batch API, waits for the batch to complete and
+        saves the generated articles from the downloaded batch response.
+
+        Args:
+        n: int
+            Number of prompts in the batch
+        """
+        message_generator = self.create_message_generator(n)
+        self.create_batch_json(
+            message_generator=message_generator, batch_jsonl_path=self.batch_jsonl_path
+        )
+
+        with open(self.batch_jsonl_path, "rb") as f:
+            batch_file = await self.client.files.create(file=f, purpose="batch")
+
+        batch = await self.client.batches.create(
+            input_file_id=batch_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h",
+        )
+        print(f"Batch {batch.id} with {n} requests created.")
+
+        batch = await self.wait_for_batch(batch.id)
+
+        # A batch in which every request failed is completed as well, but only has an error file
+        if batch.output_file_id is None:
+            raise RuntimeError(
+                f"Batch {batch.id} completed without any successful response, see the error file {batch.error_file_id}"
             )
 
+        batch_response = await self.client.files.content(batch.output_file_id)
+        with open(self.batch_response_path, "wb") as f:
+            f.write(batch_response.content)
+
+        generated_responses = self.read_batch_response_jsonl(
+            batch_response_path=self.batch_response_path
+        )
+        # Open the output file once for all responses instead of once per response
+        with open(self.article_output_path, "ab") as f:
+            for articles in tqdm(generated_responses, desc="Saved responses"):
+                self.write_generated_articles(articles, f)
+
         print(
-            f"{n} times generated and saved successfully under {self.article_output_path}."
+            f"{n} times generated with the batch API and saved successfully under {self.article_output_path}."
         )
 
+    async def wait_for_batch(self, batch_id: str, poll_interval: float = 60):
+        """
+        Polls the status of the batch until it is completed.
+
+        Args:
+        batch_id: str
+            ID of the batch returned by OpenAI's batch API
+        poll_interval: float
+            Seconds to wait between two status requests
+
+        Returns:
+        Batch
+            The completed batch
+        """
+        while True:
+            batch = await self.client.batches.retrieve(batch_id)
+
+            if batch.status == "completed":
+                return batch
+            if batch.status in ("failed", "expired", "cancelled"):
+                raise RuntimeError(f"Batch {batch_id} ended with status {batch.status}")
+
+            if batch.request_counts is not None:
+                print(
+                    f"Batch {batch_id} is {batch.status}: {batch.request_counts.completed} out of {batch.request_counts.total} requests completed."
+                )
+            else:
+                print(f"Batch {batch_id} is {batch.status}.")
+            await asyncio.sleep(poll_interval)
+
     def create_message_generator(self, n: int, custom_id_prefix: str = "request"):
         """
-        Creates a generator of the messages to be used with instructor's BatchJob which then sends the batch request to the OpenAI API.
+        Creates a generator of the requests of the batch file, one request for the chat completions endpoint per prompt.
+        The requests use the same temperature and structured output format as the single requests.
         """
 
         for i in range(0, n):
             random_articles: list[dict] = self.choose_random_articles()
             prompt = self.create_openai_prompt(random_articles)
 
-            messages = [
-                {"role": "system", "content": self.system_prompt},
-                {"role": "user", "content": prompt},
-            ]
-
-            yield messages
+            yield {
+                "custom_id": f"{custom_id_prefix}-{i}",
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": {
+                    "model": self.model_name,
+                    "messages": [
+                        {"role": "system", "content": self.system_prompt},
+                        {"role": "user", "content": prompt},
+                    ],
+                    "temperature": self.temperature,
+                    "response_format": self.response_format,
+                },
+            }
 
     def create_batch_json(self, message_generator, batch_jsonl_path: str):
         """
-        Sends a batch request to the OpenAI API with the prompts in the batch file.
+        Writes the requests to the JSON line file of the batch, one request per line.
         """
 
-        BatchJob.create_from_messages(
-            messages_batch=message_generator,
-            model=self.model_name,
-            file_path=batch_jsonl_path,
-            response_model=ArticleCorpus,
-        )
+        # Open the batch file once for all requests, which also truncates the batch file of an earlier run
+        with open(batch_jsonl_path, "wb") as f:
+            for request in message_generator:
+                f.write(orjson.dumps(request, option=orjson.OPT_APPEND_NEWLINE))
 
     def read_batch_response_jsonl(self, batch_response_path: str):
         """
-        Reads the JSON line file with the batch response from the OpenAI API and returns the responses.
+        Reads the JSON line file with the batch response from the OpenAI API line by line and yields the responses.
+        Responses that cannot be parsed into the pydantic model are skipped.
 
         Args:
         batch_response_path: str
             Path to the JSON line file with the batch response from the OpenAI API
 
-        Returns:
-        list[ArticleGenerationPrompt]
-            List of the generated articles in the pydantic model format
+        Yields:
+        ArticleCorpus
+            The generated articles of one response in the pydantic model format
         """
 
-        parsed, unparsed = BatchJob.parse_from_file(
-            file_path=batch_response_path, response_model=ArticleCorpus
-        )
-        for i, article in enumerate(parsed):
-            self.save_generated_articles(article)
-            print(f"Generated responses: {i+1} out of {len(parsed)} saved.")
-
-        # return parsed, unparsed
-
-        # with open(batch_response_path, "r") as f:
-        #     responses = f.readlines()
-
-        # responses = [json.loads(response) for response in responses]
-
-        # return responses
+        with open(batch_response_path, "rb") as f:
+            for line in f:
+                response = orjson.loads(line)
+                try:
+                    message = response["response"]["body"]["choices"][0]["message"]
+                    articles = ArticleCorpus.model_validate_json(message["content"])
+                except (KeyError, IndexError, TypeError, ValidationError):
+                    print(
+                        f"Response {response.get('custom_id')} could not be parsed and is skipped."
+                    )
+                    continue
+
+                yield articles
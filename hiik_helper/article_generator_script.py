@@ -1,8 +1,6 @@
+import asyncio
+
 from article_generator import ArticleGenerator
-from pydantic_models.article_corpus_model import (
-    ArticleCorpus,
-    read_json_to_article_generation_prompt,
-)
 
 
 def run_article_generator():
@@ -13,51 +11,36 @@ def run_article_generator():
     # Temperature parameter for the GPT model
     temperature = 0.0
 
-    # Path to the JSON file containing the articles
-    article_json_path = "found_articles.json"
+    # Path to the JSON line file containing the articles
+    article_json_path = "found_articles.jsonl"
 
-    # Path to the JSON file where the generated articles should be saved
-    article_output_path = "generated_articles.json"
+    # Path to the JSON line file where the generated articles should be saved
+    article_output_path = "generated_articles.jsonl"
 
     # Batch file path
     batch_jsonl_path = "batch_file.jsonl"
 
     # Batch response path
-    batch_response_path = "data/created_articles/batch_data/batch_2.jsonl"
-
-    # The prefix for the custom ID of the generated articles
-    custom_id_prefix = "A - request"
+    batch_response_path = "batch_response.jsonl"
 
     # Number of articles to choose from the JSON file (amount used for few shot prompting)
     num_articles_to_choose = 3
 
-    # Number of times to generate using the GPT model
+    # Number of times to generate using the GPT model, OpenAI's batch API is used from 100 times on
     times_to_generate = 1_000
 
     # Initialize the ArticleGenerator class
     article_generator = ArticleGenerator(
         article_json_path=article_json_path,
         article_output_path=article_output_path,
+        batch_jsonl_path=batch_jsonl_path,
+        batch_response_path=batch_response_path,
         num_articles_to_choose=num_articles_to_choose,
         model_name=model_name,
         temperature=temperature,
     )
-    # article_generator.generate(1)
-
-    message_generator = article_generator.create_message_generator(
-        n=times_to_generate, custom_id_prefix=custom_id_prefix
-    )
-    article_generator.create_batch_json(
-        message_generator=message_generator, batch_jsonl_path=batch_jsonl_path
-    )
-    # generated_articles = article_generator.read_batch_response_jsonl(
-    #     batch_response_path=batch_response_path
-    # )
 
-    # all_generated_articles = read_json_to_article_generation_prompt(
-    #     json_path=article_output_path
-    # )
-    print()
+    asyncio.run(article_generator.generate(times_to_generate))
 
 
 if __name__ == "__main__":
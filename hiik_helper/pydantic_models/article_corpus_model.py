@@ -1,30 +1,39 @@
-from pydantic import BaseModel, Field
-import json
+from pydantic import AliasChoices, BaseModel, Field
 
 
 class ArticleCorpus(BaseModel):
     class Article(BaseModel):
-        Headline: str = Field(description="Headline of the article")
-        Subheadline: str = Field(description="Subheadline of the article")
-        Paragraphs: str = Field(description="Paragraphs of the article")
+        # The saved articles use lower case keys, so both spellings are accepted and the lower case one is written
+        Headline: str = Field(
+            description="Headline of the article",
+            validation_alias=AliasChoices("Headline", "headline"),
+            serialization_alias="headline",
+        )
+        Subheadline: str = Field(
+            description="Subheadline of the article",
+            validation_alias=AliasChoices("Subheadline", "subheadline"),
+            serialization_alias="subheadline",
+        )
+        Paragraphs: str = Field(
+            description="Paragraphs of the article",
+            validation_alias=AliasChoices("Paragraphs", "paragraphs"),
+            serialization_alias="paragraphs",
+        )
 
     articles: list[Article]
 
 
 def read_json_to_article_generation_prompt(json_path: str) -> ArticleCorpus:
     """
-    Read the JSON file containing the articles and return the ArticleGenerationPrompt object containing the articles.
-    The headline, subheadline, and paragraphs are required for each article in the JSON file.
+    Read the JSON line file containing the articles and return the ArticleGenerationPrompt object containing the articles.
+    The headline, subheadline, and paragraphs are required for each article in the JSON line file.
+    Each line is parsed and validated in a single pass by pydantic.
     """
-    all_articles: ArticleCorpus = ArticleCorpus(articles=[])
-    with open(json_path, "r") as file:
-        articles = json.load(file)
-        for article in articles:
-            article_obj = ArticleCorpus.Article(
-                Headline=article["headline"],
-                Subheadline=article["subheadline"],
-                Paragraphs=article["paragraphs"],
-            )
-            all_articles.articles.append(article_obj)
+    with open(json_path, "rb") as file:
+        articles = [
+            ArticleCorpus.Article.model_validate_json(line)
+            for line in file
+            if line.strip()
+        ]
 
-    return all_articles
+    return ArticleCorpus(articles=articles)
@@ -0,0 +1,77 @@
+import asyncio
+import time
+
+
+class RateLimiter:
+    def __init__(self, max_requests_per_minute: float, max_tokens_per_minute: float):
+        """
+        Token bucket throttling the requests sent to the OpenAI API before they are sent, so that the
+        request and token limits of the account are not exceeded.
+        Both buckets start full and are refilled continuously up to their limit per minute.
+
+        Args:
+        max_requests_per_minute: float
+            Number of requests allowed per minute
+        max_tokens_per_minute: float
+            Number of tokens allowed per minute
+        """
+
+        self.max_requests_per_minute: float = max_requests_per_minute
+        self.max_tokens_per_minute: float = max_tokens_per_minute
+
+        self.available_request_capacity: float = max_requests_per_minute
+        self.available_token_capacity: float = max_tokens_per_minute
+        self.last_update_time: float = time.monotonic()
+
+        # Waiting requests are served in order so that large prompts are not starved by small ones
+        self.lock = asyncio.Lock()
+
+    def refill(self):
+        """
+        Refills both buckets according to the time passed since the last update.
+        """
+        now = time.monotonic()
+        seconds_since_update = now - self.last_update_time
+
+        self.available_request_capacity = min(
+            self.available_request_capacity
+            + self.max_requests_per_minute * seconds_since_update / 60,
+            self.max_requests_per_minute,
+        )
+        self.available_token_capacity = min(
+            self.available_token_capacity
+            + self.max_tokens_per_minute * seconds_since_update / 60,
+            self.max_tokens_per_minute,
+        )
+        self.last_update_time = now
+
+    async def acquire(self, n_tokens: int):
+        """
+        Waits until both buckets have room for one request with n_tokens tokens and takes the capacity.
+
+        Args:
+        n_tokens: int
+            Estimated number of tokens of the request
+        """
+        # A request larger than the limit per minute could never be sent otherwise
+        n_tokens = min(n_tokens, self.max_tokens_per_minute)
+
+        async with self.lock:
+            while True:
+                self.refill()
+
+                missing_requests = 1 - self.available_request_capacity
+                missing_tokens = n_tokens - self.available_token_capacity
+                if missing_requests <= 0 and missing_tokens <= 0:
+                    self.available_request_capacity -= 1
+                    self.available_token_capacity -= n_tokens
+                    return
+
+                # Sleep until the emptier bucket has been refilled enough
+                await asyncio.sleep(
+                    max(
+                        missing_requests * 60 / self.max_requests_per_minute,
+                        missing_tokens * 60 / self.max_tokens_per_minute,
+                        0.001,
+                    )
+                )
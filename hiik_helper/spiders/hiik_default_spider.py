@@ -1,21 +1,78 @@
 import scrapy
-import json
+import orjson
 import re
 import datetime
 import logging
+import os
 
 logger = logging.getLogger(__name__)
 
 
-from zoneinfo import ZoneInfo
+from lxml import etree
+from lxml.cssselect import CSSSelector
+from pybloom_live import ScalableBloomFilter
 from scrapy.linkextractors import LinkExtractor
 from scrapy.signals import spider_closed
 from scrapy.signalmanager import dispatcher
 
+HREF_RE = re.compile(r'href="([^"]*)"')
+HTML_TAG_RE = re.compile(r"<[^>]*>")
+
+
+def own_text_nodes(element):
+    # The same text nodes as the XPath text() on the element: its text and the tails of its children
+    texts = [element.text] if element.text else []
+    texts.extend(child.tail for child in element if child.tail)
+    return texts
+
+
+def divs_with_classes_selector(class_names: str) -> CSSSelector:
+    # Matches divs having all the given classes, regardless of their order and of further classes
+    return CSSSelector("div." + ".".join(class_names.split()))
+
+
+def elements_to_html(elements):
+    # Serialize the elements the same way as Scrapy's Selector.get()
+    return [
+        etree.tostring(element, method="html", encoding="unicode", with_tail=False)
+        for element in elements
+    ]
+
 
 class HiikDefaultSpider(scrapy.Spider):
     name = "HIIK Default Spider"
 
+    # Broad crawl tuning, the politeness settings per domain stay the ones of the project settings
+    custom_settings = {
+        "CONCURRENT_REQUESTS": 256,
+        "DNSCACHE_SIZE": 500_000,
+        "REACTOR_THREADPOOL_MAXSIZE": 40,
+        "SCHEDULER_PRIORITY_QUEUE": "scrapy.pqueues.DownloaderAwarePriorityQueue",
+    }
+
+    content_class_article = "entry-content entry clearfix"
+    content_class_list = "entry-content"
+
+    # Compile the class selectors once for the class, so all spider instances of a process share them
+    # Only the first article div is needed, so the XPath translation of its selector stops there
+    xp_article = etree.XPath(
+        f"({divs_with_classes_selector(content_class_article).path})[1]"
+    )
+    css_list = divs_with_classes_selector(content_class_list)
+
+    # The attributes set in __init__ and used for every response, stored in slots instead of the instance dict.
+    # scrapy.Spider itself has no slots, so further attributes still end up in the instance dict.
+    __slots__ = (
+        "start_urls",
+        "allowed_domains",
+        "article_link_domains",
+        "article_link_re",
+        "link_extractor",
+        "found_articles_file",
+        "visited_urls_this_scrape",
+        "visited_urls_filter",
+    )
+
     def __init__(
         self, start_urls: list[str], allowed_domains: list[str], *args, **kwargs
     ):
@@ -30,18 +87,21 @@ class HiikDefaultSpider(scrapy.Spider):
             "karennews.org/category/article",
             "karennews.org/2024",
         ]
-        self.link_extractor = LinkExtractor()
+        # Match all article link domains with a single regex instead of one substring check per domain
+        self.article_link_re = re.compile(
+            "|".join(re.escape(domain) for domain in self.article_link_domains)
+        )
+        # Built once for all responses, offsite links are already dropped by the extractor
+        self.link_extractor = LinkExtractor(allow_domains=self.allowed_domains)
 
-        self.found_articles: dict[str, dict[str, str]] = {}
-        self.content_class_article = "entry-content entry clearfix"
-        self.content_class_list = "entry-content"
+        # Found articles are appended to a JSON line file as soon as they are scraped
+        self.found_articles_file = open("found_articles.jsonl", "ab", buffering=1 << 16)
 
         self.visited_urls_this_scrape = set()
 
-        logger.info("Loading visited URLs from JSON")
-        # Load JSON file with URLs that we have already visited
-        with open("visited_urls.json", "r") as f:
-            self.visited_json_urls = json.load(f)
+        logger.info("Loading visited URLs")
+        # Load the URLs that we have already visited in earlier scrapes
+        self.visited_urls_filter: ScalableBloomFilter = self.load_visited_urls_filter()
 
         logger.info("Spider initialized")
 
@@ -51,101 +111,104 @@ class HiikDefaultSpider(scrapy.Spider):
         url = response.url
 
         if (
-            url not in self.visited_json_urls
+            url not in self.visited_urls_filter
             and url not in self.visited_urls_this_scrape
         ):
-            if self.current_page_is_article(response):
-                # Get content of the article on the page
-                article_content = self.parse_article(response)
-
-                # Add the article content to the list of found articles
-
-                for supposed_article in article_content:
-                    # Get article:modified_time from meta property
-                    article_modified_time = response.xpath(
-                        "//meta[@property='article:published_time']/@content"
-                    ).get()
-
-                    # Get the headline of the article
-                    headline = response.xpath("//h1/text()").get()
-
-                    # Get subheadline of the article
-                    subheadline = response.xpath("//h2/text()").get()
-
-                    # Get all paragraphs of the article
-                    paragraphs = response.xpath("//p/text()").getall()
-                    paragraph_text = "\n\n".join(paragraphs)
-
-                    # Add the article to the list of found articles
-                    article_dict = {
-                        "url": url,
-                        "accessing-date": str(datetime.datetime.now(datetime.UTC)),
-                        "last-modification": article_modified_time,
-                        "headline": headline,
-                        "subheadline": subheadline,
-                        "paragraphs": paragraph_text,
-                    }
-                    self.found_articles[url] = article_dict
-
-                    self.visited_urls_this_scrape.add(url)
-
-            elif self.current_page_is_list(response):
-                # Get content of the article on the page
-                article_list = self.parse_article_list(response)
+            # The lxml tree of the page, all queries run on it directly instead of wrapping results in selectors
+            root = response.selector.root
+
+            # Get content of the article on the page, only article pages have it
+            article_content = self.parse_article(root)
+
+            if article_content:
+                # The fields are taken from the whole page, so they are the same for every article div
+                # and are only extracted once per page
+                accessing_date = datetime.datetime.now(datetime.UTC)
+
+                # Get the modification time, headline, subheadline and paragraphs of the article
+                article_modified_time, headline, subheadline, paragraphs = (
+                    self.extract_article_fields(root)
+                )
+                paragraph_text = "\n\n".join(paragraphs)
+
+                # Add the article to the list of found articles
+                article_dict = {
+                    "url": url,
+                    "accessing-date": accessing_date,
+                    "last-modification": article_modified_time,
+                    "headline": headline,
+                    "subheadline": subheadline,
+                    "paragraphs": paragraph_text,
+                }
+                self.save_found_article_to_json(article_dict)
+
+                self.visited_urls_this_scrape.add(url)
+
+            else:
+                # Get the list of articles on the page, empty if the page is no list either
+                article_list = self.parse_article_list(root)
 
                 for supposed_article in article_list:
                     # Get the more link of the article
                     more_link_url = self.get_url_in_article(supposed_article)
-                    if self.link_is_article(more_link_url):
+                    if more_link_url and self.link_is_article(more_link_url):
                         article_links.add(more_link_url)
 
         extracted_links = self.link_extractor.extract_links(response)
         # Filter out the article links
 
-        article_links = article_links.union(
-            set(
-                [link.url for link in extracted_links if self.link_is_article(link.url)]
-            )
+        article_links.update(
+            link.url for link in extracted_links if self.link_is_article(link.url)
         )
 
-        yield_links = [
-            link
-            for link in article_links
-            if link not in self.visited_json_urls
-            and link not in self.visited_urls_this_scrape
-        ]
-
-        # Follow the next article link
-        for link in yield_links:
+        # Follow the next article link, visited links are skipped before a request is built for them.
+        # The set of this scrape is checked first as it is cheaper than the Bloom filter.
+        for link in article_links:
+            if link in self.visited_urls_this_scrape or link in self.visited_urls_filter:
+                continue
             yield response.follow(link, callback=self.parse)
 
-    def current_page_is_article(self, response):
-        # Check if the current page is an article
-        if response.xpath(f'//div[@class="{self.content_class_article}"]'):
-            return True
-        return False
-
-    def current_page_is_list(self, response):
-        # Check if the current page is a list of articles
-        if response.xpath(f'//div[@class="{self.content_class_list}"]'):
-            return True
-        return False
-
-    def parse_article(self, response):
+    def extract_article_fields(self, root):
+        # Walk the tree once for all fields instead of running a separate XPath query for each of them
+        article_modified_time = None
+        headline = None
+        subheadline = None
+        paragraphs = []
+
+        for element in root.iter("meta", "h1", "h2", "p"):
+            if element.tag == "meta":
+                # Get article:modified_time from meta property
+                if (
+                    article_modified_time is None
+                    and element.get("property") == "article:published_time"
+                ):
+                    article_modified_time = element.get("content")
+            elif element.tag == "p":
+                # One string per paragraph including the text of nested tags like links, empty paragraphs are left out
+                paragraph = "".join(element.itertext())
+                if paragraph:
+                    paragraphs.append(paragraph)
+            elif element.tag == "h1":
+                if headline is None:
+                    headline = next(iter(own_text_nodes(element)), None)
+            elif subheadline is None:
+                subheadline = next(iter(own_text_nodes(element)), None)
+
+        return article_modified_time, headline, subheadline, paragraphs
+
+    def parse_article(self, root):
         # Parse the article content
         # Mocked implementation
-        return response.xpath(f'//div[@class="{self.content_class_article}"]').getall()
+        return self.xp_article(root)
 
-    def parse_article_list(self, response):
+    def parse_article_list(self, root):
         # Parse the article content
         # Mocked implementation
-        return response.xpath(f'//div[@class="{self.content_class_list}"]').getall()
+        return elements_to_html(self.css_list(root))
 
     def link_is_article(self, url):
         # Check if the link is an article
-        for article_link_domain in self.article_link_domains:
-            if article_link_domain in url:
-                return True
+        return self.article_link_re.search(url) is not None
 
     def article_contains_more_link(self, article):
         # Check if the article contains a more link
@@ -153,41 +216,66 @@ class HiikDefaultSpider(scrapy.Spider):
         return "more-link button" in article
 
     def get_url_in_article(self, article):
-        # Get the more link in the article
-        url = re.findall(r'href="([^"]*)"', article)[0]
-        return url
+        # Get the more link in the article, only the first link is needed
+        match = HREF_RE.search(article)
+        return match.group(1) if match else None
 
     def clean_text_from_html(self, text):
         # Clean the text from HTML tags
         # Mocked implementation
-        return re.sub(r"<[^>]*>", "", text)
+        return HTML_TAG_RE.sub("", text)
+
+    def save_found_article_to_json(self, article_dict):
+        # Append the found article as a single line, so the already saved articles never need to be read
+        # orjson writes the accessing date as an ISO 8601 string
+        self.found_articles_file.write(
+            orjson.dumps(article_dict, option=orjson.OPT_APPEND_NEWLINE)
+        )
 
-    def save_found_articles_to_json(self):
-        json_file_name = "found_articles.json"
+    def load_visited_urls_filter(self):
+        # The URLs of earlier scrapes are kept in a Bloom filter, which needs a few bits per URL instead of the URL itself.
+        # In return a new URL is taken for a visited one with the probability of the error rate.
+        # The Bloom filter file is the only source of truth for the visited URLs, the JSON file used before it
+        # only seeds a new Bloom filter and is deleted once that has been saved.
+        bloom_file_name = "visited_urls.bloom"
+        json_file_name = "visited_urls.json"
 
-        # Save the found articles to a JSON file
-        with open(json_file_name, "r") as f:
-            data = json.load(f)
+        if os.path.exists(bloom_file_name):
+            with open(bloom_file_name, "rb") as f:
+                return ScalableBloomFilter.fromfile(f)
 
-        data.update(self.found_articles)
+        # Fill a new Bloom filter with the URLs from the JSON file used before the Bloom filter
+        visited_urls_filter = ScalableBloomFilter(
+            initial_capacity=10_000, error_rate=1e-5
+        )
+        if os.path.exists(json_file_name):
+            with open(json_file_name, "rb") as f:
+                for url in orjson.loads(f.read()):
+                    visited_urls_filter.add(url)
 
-        with open(json_file_name, "w") as f:
-            json.dump(data, f, indent=4)
+        return visited_urls_filter
 
-    def save_visited_urls_to_json(self):
+    def save_visited_urls_to_bloom_filter(self):
+        bloom_file_name = "visited_urls.bloom"
         json_file_name = "visited_urls.json"
 
-        self.visited_json_urls.extend(self.visited_urls_this_scrape)
+        for url in self.visited_urls_this_scrape:
+            self.visited_urls_filter.add(url)
+
+        # Save the Bloom filter of the visited URLs to a file
+        with open(bloom_file_name, "wb") as f:
+            self.visited_urls_filter.tofile(f)
 
-        # Save the visited URLs to a JSON file
-        with open(json_file_name, "w") as f:
-            json.dump(list(self.visited_json_urls), f, indent=4)
+        # The URLs of the JSON file are in the saved Bloom filter now, so it would only go stale from here on
+        if os.path.exists(json_file_name):
+            logger.info(f"Removing {json_file_name}, its URLs are in {bloom_file_name}")
+            os.remove(json_file_name)
 
     def spider_closing(self, spider):
         logger.info("Spider closing")
 
-        logger.info(f"Saving visited URLs to JSON")
-        self.save_visited_urls_to_json()
+        logger.info(f"Saving visited URLs to Bloom filter")
+        self.save_visited_urls_to_bloom_filter()
 
-        logger.info(f"Saving found articles to JSON")
-        self.save_found_articles_to_json()
+        logger.info(f"Closing found articles JSON line file")
+        self.found_articles_file.close()
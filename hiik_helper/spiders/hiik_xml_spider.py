@@ -10,6 +10,7 @@ logger = logging.getLogger(__name__)
 
 
 from zoneinfo import ZoneInfo
+from lxml import etree
 from scrapy.linkextractors import LinkExtractor
 from scrapy.signals import spider_closed
 from scrapy.signalmanager import dispatcher
@@ -34,6 +35,10 @@ class HiikXmlSpider(scrapy.spiders.XMLFeedSpider):
         itertag = "item"  # Adjust this to match your XML structure
         # namespaces = [("ns", "http://example.com/namespace")]  # Example namespace
 
+        # Compile the XPath expressions of the feed items once instead of for every node
+        self.xp_title = etree.XPath("ns:title/text()", namespaces=dict(self.namespaces))
+        self.xp_link = etree.XPath("ns:link/text()", namespaces=dict(self.namespaces))
+
     # def parse_node(self, response, node):
     #     # Save all links from the XML feed
     #     links = node.xpath("ns:link/text()", namespaces=self.namespaces).getall()
@@ -44,13 +49,17 @@ class HiikXmlSpider(scrapy.spiders.XMLFeedSpider):
     #     }
 
     def parse_node(self, response, node):
-        self.logger.info(
-            "Hi, this is a <%s> node!: %s", self.itertag, "".join(node.getall())
-        )
+        # Serializing the node is only worth it when the debug log is shown
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug("Hi, this is a <%s> node!: %s", self.itertag, node.get())
+
+        titles = self.xp_title(node.root)
+        links = self.xp_link(node.root)
 
+        # lxml's smart strings keep a reference to their document, so plain strings are returned
         return {
-            "title": node.xpath("ns:title/text()", namespaces=self.namespaces).get(),
-            "link": node.xpath("ns:link/text()", namespaces=self.namespaces).get(),
+            "title": str(titles[0]) if titles else None,
+            "link": str(links[0]) if links else None,
         }
     
     def spider_closing(self):